@@ -24,7 +24,6 @@ class TokenMetrics:
     tokens_processed: int = 0
     tokens_per_second: float = 0.0
     average_token_length: float = 0.0
-    pattern_match_time_ms: float = 0.0
     trigger_execution_time_ms: float = 0.0
 
 @dataclass
@@ -86,7 +85,6 @@ class MetricsCollector:
         self.system.uptime_seconds = time.time() - self.start_time
         
     def record_token_processed(self, token: str, 
-                             pattern_time: float,
                              trigger_time: float):
         """Record token processing metrics"""
         self.tokens.tokens_processed += 1
@@ -95,7 +93,6 @@ class MetricsCollector:
              (self.tokens.tokens_processed - 1) +
              len(token)) / self.tokens.tokens_processed
         )
-        self.tokens.pattern_match_time_ms = pattern_time * 1000
         self.tokens.trigger_execution_time_ms = trigger_time * 1000
         
     def record_error(self, error: Exception):
@@ -1,92 +1,156 @@
 import asyncio
-import json
+import hashlib
+import orjson
+import ormsgpack
 import os
+import queue
+import re
 from dotenv import load_dotenv
 import logging
-import uuid
-import os
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import socket
 import sqlite3
+import threading
+import time
 import websockets
-import requests
-import aiometer
+import httpx
+from collections import deque
 from datetime import datetime, timedelta
-from prometheus_client import Counter, Histogram, start_http_server
 from asyncio import Queue
-from dataclasses import dataclass
-from typing import Dict, Set
-from typing import List, Optional, Union, Dict, Any, Annotated
-from contextlib import contextmanager
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from typing import Optional, Set, Annotated
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from cachetools import TTLCache
+from pathlib import Path
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Request
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
+from modal import Image, App, Secret, asgi_app, concurrent
+from token_retry import RETRYABLE_STATUSES, TOKEN_MAX_ATTEMPTS, backoff_delay
+
+# pybase64 wraps libbase64's SIMD codec and is a drop-in for the stdlib module
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 class Token(BaseModel):
     access_token: str
     token_type: str
-from modal import Image, App, asgi_app
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from typing import List, Optional
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("/root/data/realtime.log")
-    ]
-)
+
+# Configure logging. The event loop only enqueues records; a listener
+# thread formats them and does the blocking stream and file writes.
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.StreamHandler(),
+    logging.FileHandler("/root/data/realtime.log")
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# Pre-serialized frame fragments; only the variable part goes through orjson
+_ERR_PREFIX = b'{"type":"error","error":'
+_ERR_SUFFIX = b'}'
+# Seconds between flushes of per-relay message counts into the monitor
+METRICS_FLUSH_INTERVAL = 1.0
+# Frames buffered per relay direction before the reader waits on the writer
+OUTBOUND_QUEUE_SIZE = 256
+# Upper bound on queued raw audio chunks merged into one binary message
+AUDIO_COALESCE_BYTES = 4096
+# A client frame whose leading keys are a top-level event_id and type (in
+# either order) already has everything the relay would add, so it goes
+# upstream untouched. Anchoring on the leading keys keeps an "event_id"
+# nested in a value or string from passing for a top-level one.
+_RAW_FORWARD_PREFIX = re.compile(
+    r'\s*\{\s*(?:"event_id"\s*:\s*"[^"\\]*"\s*,\s*"type"\s*:\s*"[^"\\]*"'
+    r'|"type"\s*:\s*"[^"\\]*"\s*,\s*"event_id"\s*:\s*"[^"\\]*")'
+)
+# Substring every upstream audio event must contain (the "audio" type value)
+_AUDIO_PROBE = '"audio"'
+
+def error_frame(error: dict) -> str:
+    """Build an error frame around an already-shaped error dict"""
+    return (_ERR_PREFIX + orjson.dumps(error) + _ERR_SUFFIX).decode()
+
+# Fully constant frames are serialized once at import
+INVALID_JSON_FRAME = error_frame({"message": "Invalid JSON message"})
+INVALID_MSGPACK_FRAME = error_frame({"message": "Invalid MessagePack message"})
+
+def _msgpack_default(obj):
+    """JSON form of MessagePack-only values: bin payloads go upstream as base64"""
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    raise TypeError
+# The ack only varies by timestamp, which never needs JSON escaping
+_ACK_TEMPLATE = '{"type":"connection.established","timestamp":"%s"}'
+# Echo reply; the slot takes an already JSON-encoded string
+_ECHO_TEMPLATE = '{"type":"message","sender":"Server","text":%s}'
+
 # Simple in-memory monitoring
 class ServiceMonitor:
     """Simple in-memory service monitoring"""
     def __init__(self):
+        # Bounded deques drop the oldest entry in O(1) once full
         self.metrics = {
             'websocket_connections': 0,
             'websocket_messages': 0,
-            'processing_times': [],
-            'errors': [],
-            'last_updated': datetime.now()
+            'processing_times': deque(maxlen=1000),
+            'errors': deque(maxlen=100),
         }
+        # Raw epoch seconds; only turned into a datetime when stats are read
+        self._last_updated = time.time()
+        # Running sum of processing_times so the average is O(1)
+        self._processing_time_total = 0.0
     
     def increment(self, metric: str):
         if metric in self.metrics:
             if isinstance(self.metrics[metric], int):
                 self.metrics[metric] += 1
-        self.metrics['last_updated'] = datetime.now()
+        self._last_updated = time.time()
     
+    def add(self, metric: str, amount: int):
+        """Apply a locally aggregated count in one update"""
+        if metric in self.metrics:
+            if isinstance(self.metrics[metric], int):
+                self.metrics[metric] += amount
+        self._last_updated = time.time()
+
     def decrement(self, metric: str):
         if metric in self.metrics:
             if isinstance(self.metrics[metric], int):
                 self.metrics[metric] = max(0, self.metrics[metric] - 1)
-        self.metrics['last_updated'] = datetime.now()
+        self._last_updated = time.time()
     
     def add_timing(self, seconds: float):
-        self.metrics['processing_times'].append(seconds)
-        # Keep only last 1000 timings
-        self.metrics['processing_times'] = self.metrics['processing_times'][-1000:]
-        self.metrics['last_updated'] = datetime.now()
+        timings = self.metrics['processing_times']
+        if len(timings) == timings.maxlen:
+            self._processing_time_total -= timings[0]
+        timings.append(seconds)
+        self._processing_time_total += seconds
+        self._last_updated = time.time()
     
     def add_error(self, error: str):
         self.metrics['errors'].append({
             'error': error,
             'timestamp': datetime.now()
         })
-        # Keep only last 100 errors
-        self.metrics['errors'] = self.metrics['errors'][-100:]
-        self.metrics['last_updated'] = datetime.now()
+        self._last_updated = time.time()
     
     def get_stats(self) -> dict:
         stats = self.metrics.copy()
+        stats['last_updated'] = datetime.fromtimestamp(self._last_updated)
         if self.metrics['processing_times']:
-            stats['avg_processing_time'] = sum(self.metrics['processing_times']) / len(self.metrics['processing_times'])
+            stats['avg_processing_time'] = self._processing_time_total / len(self.metrics['processing_times'])
         else:
             stats['avg_processing_time'] = 0
         return stats
@@ -97,54 +161,58 @@ monitor = ServiceMonitor()
 RATE_LIMIT = 100  # requests per minute
 RATE_WINDOW = 60  # seconds
 
-@dataclass
-class RateLimit:
-    """Rate limiting data"""
-    count: int = 0
-    window_start: float = 0
-
 class RateLimiter:
     """Rate limiting implementation"""
     def __init__(self):
-        self.clients: Dict[str, RateLimit] = {}
+        # client_id -> (count, window_start); idle clients age out instead of
+        # accumulating forever
+        self.clients: TTLCache = TTLCache(maxsize=100_000, ttl=RATE_WINDOW * 2)
     
-    async def check_rate_limit(self, client_id: str) -> bool:
-        now = datetime.now().timestamp()
-        if client_id not in self.clients:
-            self.clients[client_id] = RateLimit(count=1, window_start=now)
+    def check_rate_limit(self, client_id: str) -> bool:
+        # Only elapsed time matters here, so use the cheap monotonic clock
+        now = time.monotonic()
+        entry = self.clients.get(client_id)
+        if entry is None or now - entry[1] > RATE_WINDOW:
+            self.clients[client_id] = (1, now)
             return True
             
-        rate_data = self.clients[client_id]
-        if now - rate_data.window_start > RATE_WINDOW:
-            rate_data.count = 1
-            rate_data.window_start = now
-            return True
-            
-        if rate_data.count >= RATE_LIMIT:
+        count, window_start = entry
+        if count >= RATE_LIMIT:
             return False
             
-        rate_data.count += 1
+        self.clients[client_id] = (count + 1, window_start)
         return True
 
 rate_limiter = RateLimiter()
 
 # Connection pool
 class ConnectionPool:
-    """Manages a pool of upstream connections"""
+    """
+    Manages a bounded pool of upstream connections. Idle relays sit in the
+    queue; new ones are created only while fewer than max_size exist, after
+    which acquire waits for a release.
+    """
     def __init__(self, max_size: int = 10):
         self.max_size = max_size
-        self.pool: Set[RealtimeRelay] = set()
-        self.queue = Queue()
+        self.size = 0
+        self.queue: Queue = Queue(maxsize=max_size)
         
     async def acquire(self) -> 'RealtimeRelay':
-        if len(self.pool) < self.max_size:
-            relay = await self._create_relay()
-            self.pool.add(relay)
-            return relay
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        if self.size < self.max_size:
+            self.size += 1
+            try:
+                return await self._create_relay()
+            except BaseException:
+                self.size -= 1
+                raise
         return await self.queue.get()
         
-    async def release(self, relay: 'RealtimeRelay'):
-        await self.queue.put(relay)
+    def release(self, relay: 'RealtimeRelay'):
+        self.queue.put_nowait(relay)
         
     async def _create_relay(self) -> 'RealtimeRelay':
         # Implementation depends on your RealtimeRelay class
@@ -156,21 +224,98 @@ connection_pool = ConnectionPool()
 SECRET_KEY = os.getenv("APP_SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# bcrypt work factor for new hashes; lower it (e.g. 10) for dev containers
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+@lru_cache(maxsize=None)
+def _pwd_ctx():
+    """Build the bcrypt context on first use; passlib is slow to import"""
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Database configuration
 DATABASE_URL = "/root/data/realtime.db"
 
+DB_POOL_SIZE = 4
+
+# Long-lived connections shared by the worker threads that run queries. The
+# pool is filled on first use, once fastapi_app() has created the data dir.
+_db_pool: Optional[queue.Queue] = None
+_db_pool_lock = threading.Lock()
+
+def _open_db() -> sqlite3.Connection:
+    """Open a pooled connection and apply the pragmas once"""
+    conn = sqlite3.connect(DATABASE_URL, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    return conn
+
+def _get_db_pool() -> queue.Queue:
+    """Create the connection pool on first use"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            pool = queue.Queue(maxsize=DB_POOL_SIZE)
+            for _ in range(DB_POOL_SIZE):
+                pool.put(_open_db())
+            _db_pool = pool
+    return _db_pool
+
 @contextmanager
 def get_db():
     """Get database connection"""
-    conn = sqlite3.connect(DATABASE_URL)
+    pool = _get_db_pool()
+    conn = pool.get()
     try:
         yield conn
     finally:
-        conn.close()
+        pool.put(conn)
+
+# Shared client for OpenAI REST calls, open for the lifetime of the app so
+# the keep-alive (HTTP/2) connection is reused across session inits
+openai_http: Optional[httpx.AsyncClient] = None
+
+async def warm_openai_connection():
+    """
+    Open the TLS/HTTP2 connection to api.openai.com ahead of the first
+    session, so create_ephemeral_token finds it in the pool.
+    """
+    openai_api_key = os.getenv('OPENAI_API_KEY')
+    if not openai_api_key:
+        return
+    try:
+        await openai_http.get(
+            "https://api.openai.com/v1/models",
+            headers={"Authorization": f"Bearer {openai_api_key}"},
+            timeout=5
+        )
+    except httpx.HTTPError as e:
+        logger.warning("Could not pre-warm OpenAI connection: %s", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up and tear down app-wide resources"""
+    global openai_http
+    # Uvicorn picks uvloop automatically when it is installed in the image
+    loop = asyncio.get_running_loop()
+    logger.info("Serving on %s.%s", type(loop).__module__, type(loop).__name__)
+    openai_http = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    # Runs in the background so it never delays startup
+    warm_task = asyncio.create_task(warm_openai_connection())
+    try:
+        yield
+    finally:
+        warm_task.cancel()
+        await openai_http.aclose()
 
 # Create FastAPI app with WebSocket support
 web_app = FastAPI(
@@ -178,15 +323,13 @@ web_app = FastAPI(
     description="WebSocket relay for realtime communication", 
     version="1.0.0",
     root_path="",
-    root_path_in_servers=False
+    root_path_in_servers=False,
+    lifespan=lifespan
 )
 
 # Set up templates and static files
-import os
-from pathlib import Path
-
-# Get current directory
-current_dir = Path(__file__).parent
+# Get current directory, resolved once at import
+current_dir = Path(__file__).resolve().parent
 
 # Set up templates and static directories
 templates_dir = current_dir / "templates"
@@ -194,6 +337,8 @@ static_dir = current_dir / "static"
 
 # Configure templates with absolute path
 templates = Jinja2Templates(directory=str(templates_dir))
+# Templates are baked into the image, so skip the per-render mtime check
+templates.env.auto_reload = False
 
 # Mount static files with absolute path and name
 web_app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
@@ -220,44 +365,65 @@ def get_user(email: str) -> Optional[UserInDB]:
     """Get user from database by email"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-        user = cursor.fetchone()
-        if user:
-            return UserInDB(**user)
+        cursor.execute(
+            "SELECT email, hashed_password, is_superuser FROM users WHERE email = ?",
+            (email,)
+        )
+        row = cursor.fetchone()
+        if row:
+            return UserInDB(
+                email=row["email"],
+                hashed_password=row["hashed_password"],
+                is_superuser=bool(row["is_superuser"])
+            )
     return None
 
-def create_user(user: UserCreate) -> UserInDB:
-    """Create new user in database"""
-    hashed_password = pwd_context.hash(user.password)
-    is_superuser = user.email.endswith("@brainchain.ai")
-    
+def insert_user(email: str, hashed_password: str, is_superuser: bool) -> None:
+    """Insert a user row"""
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO users (email, hashed_password, is_superuser) VALUES (?, ?, ?)",
-            (user.email, hashed_password, is_superuser)
+            (email, hashed_password, is_superuser)
         )
         conn.commit()
-        
+
+async def create_user(user: UserCreate) -> UserInDB:
+    """Create new user in database"""
+    # bcrypt is deliberately slow; hash in a worker thread, not on the loop
+    hashed_password = await asyncio.to_thread(_pwd_ctx().hash, user.password)
+    is_superuser = user.email.endswith("@brainchain.ai")
+    await asyncio.to_thread(insert_user, user.email, hashed_password, is_superuser)
     return UserInDB(
         email=user.email,
         hashed_password=hashed_password,
         is_superuser=is_superuser
     )
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+# Successful verifications, keyed by a digest of (password, hash), so repeat
+# logins within a minute skip the KDF; a changed hash never matches
+_password_cache: TTLCache = TTLCache(maxsize=2048, ttl=60)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify password against hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+    key = hashlib.sha256(f"{plain_password}\0{hashed_password}".encode()).digest()
+    if key in _password_cache:
+        return True
+    verified = await asyncio.to_thread(_pwd_ctx().verify, plain_password, hashed_password)
+    if verified:
+        _password_cache[key] = True
+    return verified
 
-def authenticate_user(email: str, password: str) -> Optional[UserInDB]:
+async def authenticate_user(email: str, password: str) -> Optional[UserInDB]:
     """Authenticate user by email and password"""
-    user = get_user(email)
-    if not user or not verify_password(password, user.hashed_password):
+    user = await asyncio.to_thread(get_user, email)
+    if not user or not await verify_password(password, user.hashed_password):
         return None
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create JWT access token"""
+    from jose import jwt
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
@@ -266,8 +432,20 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+# Authenticated requests, keyed by a 16-byte BLAKE2b digest of the token
+# (never the token itself) -> (user, exp). A hit skips both the JWT decode
+# and the user lookup; the TTL bounds how long a revoked user stays valid.
+# Users are only ever inserted here, so no cached entry needs invalidating.
+_auth_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> UserInDB:
     """Get current user from JWT token"""
+    from jose import JWTError, jwt
+    token_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _auth_cache.get(token_key)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -281,11 +459,30 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> Use
     except JWTError:
         raise credentials_exception
         
-    user = get_user(email)
+    user = await asyncio.to_thread(get_user, email)
     if user is None:
         raise credentials_exception
+    if "exp" in payload:
+        _auth_cache[token_key] = (user, payload["exp"])
     return user
 
+# Subprotocol marker the chat client sends ahead of its JWT
+WS_AUTH_SUBPROTOCOL = "bearer"
+
+def session_expired(websocket: WebSocket) -> bool:
+    """
+    Check the exp claim of the JWT a websocket authenticated with. This is
+    not an access control: /ws also accepts clients that send no token
+    (cli.py, static/chat.js), and those never expire.
+    """
+    claims = getattr(websocket.state, "claims", None)
+    return claims is not None and claims.get("exp", float("inf")) <= time.time()
+
+async def close_expired_session(websocket: WebSocket):
+    """Close a socket whose JWT has expired and end its handler"""
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token expired")
+    raise WebSocketDisconnect(code=status.WS_1008_POLICY_VIOLATION)
+
 async def get_current_superuser(
     current_user: Annotated[UserInDB, Depends(get_current_user)]
 ) -> UserInDB:
@@ -297,12 +494,6 @@ async def get_current_superuser(
         )
     return current_user
 
-from pathlib import Path
-
-# Get current directory for mounting
-CURRENT_DIR = Path(__file__).parent
-import dotenv
-
 # Create Modal app and image
 # Load environment variables
 load_dotenv()
@@ -310,7 +501,7 @@ load_dotenv()
 app = App("realtime-relay")
 image = (
     Image.debian_slim()
-    .pip_install(["fastapi", "uvicorn", "python-dotenv", "websockets>=12.0", "requests", "python-multipart", "python-jose[cryptography]", "passlib", "jinja2"])
+    .pip_install(["fastapi", "uvicorn", "python-dotenv", "websockets>=14.0", "httpx[http2]", "python-multipart", "python-jose[cryptography]", "passlib", "jinja2", "orjson", "ormsgpack", "uvloop", "cachetools", "pybase64"])
     # Mount the templates directory
     .add_local_dir(
         "templates",
@@ -330,203 +521,331 @@ image = (
         remote_path="/root/data",
         create_local_dir=True
     )
+    # Retry policy shared with relay_server.py
+    .add_local_python_source("token_retry")
 )
 
+REALTIME_URL = "wss://api.openai.com/v1/realtime"
+
+# websockets.connect options for the OpenAI upstream. Audio payloads are
+# base64 of already-compact PCM, so permessage-deflate only burns CPU.
+UPSTREAM_CONNECT_OPTIONS = {
+    "compression": None,
+    "open_timeout": 5,
+    # The protocol-level keepalive replaces a Python-side health-check
+    # timer: the library pings every 30s and closes the socket if no
+    # pong arrives within 20s, which ends the relay loop.
+    "ping_interval": 30,
+    "ping_timeout": 20,
+    "close_timeout": 2,
+    "max_size": 2**24,
+    # Stays bounded: this is what pushes back on OpenAI over TCP when the
+    # browser side falls behind
+    "max_queue": 1024,
+    "write_limit": 2**20,
+}
+
+def tune_upstream_socket(sock) -> None:
+    """Disable Nagle and enable TCP keepalive on an upstream socket"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Keepalive timings are Linux-specific; skip them elsewhere
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+
+# Relays with an open session. Upstream liveness is the websockets
+# keepalive's job (see UPSTREAM_CONNECT_OPTIONS), so nothing sweeps these.
+live_relays: Set["RealtimeRelay"] = set()
+
 class RealtimeRelay:
     """
     Manages a single upstream connection to the OpenAI Realtime API.
-    Includes health checking and automatic reconnection.
+    Liveness is left to the websockets ping/pong keepalive; includes
+    automatic reconnection.
     """
     def __init__(self, ephemeral_token: str, session_config: dict):
         self.ephemeral_token = ephemeral_token
         self.session_config = session_config
         self.upstream_ws = None
         self.healthy = True
-        self.last_heartbeat = datetime.now()
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 3
-        self.message_queue = Queue()
-        asyncio.create_task(self._health_check())
-        asyncio.create_task(self._process_queue())
-
-    async def connect_upstream(self):
-        """Connect to the Realtime API over WebSocket using ephemeral token."""
-        base_url = "wss://api.openai.com/v1/realtime"
-        model = self.session_config.get("model", None)
-        if model:
-            base_url += f"?model={model}"
-
-        headers = {
-            "Authorization": f"Bearer {self.ephemeral_token}",
+        # Event ids: random per-relay prefix plus a counter, no RNG per message
+        self._evt_prefix = f"evt_{os.urandom(3).hex()}_"
+        self._evt_seq = 0
+        # Fixed for the relay's lifetime; reconnects reuse them as-is
+        model = session_config.get("model", None)
+        self._url = f"{REALTIME_URL}?model={model}" if model else REALTIME_URL
+        self._headers = {
+            "Authorization": f"Bearer {ephemeral_token}",
             "OpenAI-Beta": "realtime=v1"
         }
+        live_relays.add(self)
 
+    async def connect_upstream(self):
+        """Connect to the Realtime API over WebSocket using ephemeral token."""
         try:
-            logger.info(f"Connecting upstream to {base_url} ...")
+            logger.info("Connecting upstream to %s ...", self._url)
             self.upstream_ws = await websockets.connect(
-                base_url, 
-                additional_headers=headers,
-                ping_interval=20,
-                ping_timeout=10
+                self._url,
+                additional_headers=self._headers,
+                **UPSTREAM_CONNECT_OPTIONS
             )
+            sock = self.upstream_ws.transport.get_extra_info("socket")
+            if sock is not None:
+                tune_upstream_socket(sock)
             logger.info("Upstream connected.")
             self.healthy = True
             self.reconnect_attempts = 0
         except Exception as e:
-            logger.error(f"Connection error: {e}")
+            logger.error("Connection error: %s", e)
             self.healthy = False
             await self._handle_reconnect()
             
-    async def _health_check(self):
-        """Periodic health check"""
-        while True:
-            await asyncio.sleep(30)
-            if self.upstream_ws and not self.upstream_ws.closed:
-                try:
-                    pong = await self.upstream_ws.ping()
-                    await asyncio.wait_for(pong, timeout=10)
-                    self.last_heartbeat = datetime.now()
-                    self.healthy = True
-                except:
-                    self.healthy = False
-                    await self._handle_reconnect()
-                    
     async def _handle_reconnect(self):
         """Handle reconnection logic"""
         if self.reconnect_attempts < self.max_reconnect_attempts:
             self.reconnect_attempts += 1
             backoff = min(30, 2 ** self.reconnect_attempts)
-            logger.info(f"Attempting reconnect in {backoff} seconds...")
+            logger.info("Attempting reconnect in %s seconds...", backoff)
             await asyncio.sleep(backoff)
             await self.connect_upstream()
         else:
             logger.error("Max reconnection attempts reached")
             
-    async def _process_queue(self):
-        """Process queued messages"""
-        while True:
-            message = await self.message_queue.get()
-            if self.healthy and self.upstream_ws:
-                try:
-                    await self.upstream_ws.send(json.dumps(message))
-                except Exception as e:
-                    logger.error(f"Failed to send message: {e}")
-                    await self.message_queue.put(message)
-                    self.healthy = False
-                    await self._handle_reconnect()
-
     async def close(self):
+        live_relays.discard(self)
         if self.upstream_ws:
             await self.upstream_ws.close()
 
-from modal import Secret, Mount
+def relay_stats() -> dict:
+    """Counts for /health, read from the live relays when requested"""
+    relays = list(live_relays)
+    return {
+        "active": len(relays),
+        "unhealthy": sum(
+            1 for r in relays
+            if not r.healthy or (r.upstream_ws is not None and r.upstream_ws.close_code is not None)
+        )
+    }
+
+# Session config fields accepted by the /v1/realtime/sessions endpoint.
+# A tuple: the payload is built by probing these 12 keys, so the work does
+# not grow with whatever else the client put in its session config.
+EPHEMERAL_SESSION_KEYS = (
+    "model", "modalities", "instructions", "voice",
+    "input_audio_format", "output_audio_format",
+    "input_audio_transcription", "turn_detection",
+    "tools", "tool_choice", "temperature",
+    "max_response_output_tokens"
+)
+EPHEMERAL_SESSIONS_URL = "https://api.openai.com/v1/realtime/sessions"
+_MISSING = object()
 
 @app.function(
     secrets=[Secret.from_name("distributed-systems")]
 )
-def create_ephemeral_token(session_config: dict) -> str:
+async def create_ephemeral_token(session_config: dict) -> str:
     """Create ephemeral token for Realtime API access."""
+    get = session_config.get
     payload = {
-        k: session_config[k]
-        for k in [
-            "model", "modalities", "instructions", "voice",
-            "input_audio_format", "output_audio_format",
-            "input_audio_transcription", "turn_detection",
-            "tools", "tool_choice", "temperature",
-            "max_response_output_tokens"
-        ]
-        if k in session_config
+        k: v for k in EPHEMERAL_SESSION_KEYS
+        if (v := get(k, _MISSING)) is not _MISSING
     }
     openai_api_key = os.getenv('OPENAI_API_KEY')
-    print(openai_api_key)
     if not openai_api_key:
         raise RuntimeError("OPENAI_API_KEY environment variable is not set")
-    url = "https://api.openai.com/v1/realtime/sessions"
     headers = {
         "Authorization": f"Bearer {openai_api_key}",
         "Content-Type": "application/json",
         "OpenAI-Beta": "realtime=v1"
     }
 
-    resp = requests.post(url, headers=headers, json=payload)
-    if resp.status_code != 200:
-        raise RuntimeError(f"Failed ephemeral token: {resp.text}")
-    data = resp.json()
-    return data["client_secret"]["value"]
+    # Content-Type is set above, so send orjson's bytes rather than json=
+    body = orjson.dumps(payload)
+    for attempt in range(TOKEN_MAX_ATTEMPTS):
+        resp = await openai_http.post(EPHEMERAL_SESSIONS_URL, headers=headers, content=body)
+        if resp.status_code == 200:
+            return resp.json()["client_secret"]["value"]
+        if resp.status_code not in RETRYABLE_STATUSES or attempt == TOKEN_MAX_ATTEMPTS - 1:
+            raise RuntimeError(f"Failed ephemeral token: {resp.text}")
+        await asyncio.sleep(backoff_delay(attempt, resp.headers.get("Retry-After")))
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    async def connect(self, websocket: WebSocket, subprotocol: Optional[str] = None):
+        await websocket.accept(subprotocol=subprotocol)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
 manager = ConnectionManager()
 
-async def handle_client(websocket: WebSocket, relay: Optional[RealtimeRelay] = None):
-    """Handle bi-directional relay between client and OpenAI."""
-    try:
-        async def relay_local_to_upstream():
-            while True:
-                data_str = await websocket.receive_text()
-                data = json.loads(data_str)
-                if "event_id" not in data:
-                    data["event_id"] = f"evt_{uuid.uuid4().hex[:6]}"
-                await relay.upstream_ws.send(json.dumps(data))
+async def handle_client(websocket: WebSocket, relay: Optional[RealtimeRelay] = None,
+                        wire_format: str = "json"):
+    """
+    Handle bi-directional relay between client and OpenAI. With
+    wire_format="msgpack" every client frame is a binary MessagePack
+    message; the upstream hop stays JSON either way.
+    """
+    use_msgpack = wire_format == "msgpack"
+    # Relayed frames are counted locally and flushed to the monitor once a
+    # second, keeping dict writes and clock reads off the per-frame path
+    message_count = 0
+
+    def flush_message_count():
+        nonlocal message_count
+        if message_count:
+            monitor.add('websocket_messages', message_count)
+            message_count = 0
+
+    async def flush_metrics():
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+            flush_message_count()
+
+    # Upstream sends go straight to the websocket and rely on its write
+    # buffer for backpressure. Client sends go through one writer task fed
+    # by a bounded queue, which lets it merge queued audio chunks.
+    to_client: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+    upstream_send = relay.upstream_ws.send
+    match_raw_forward = _RAW_FORWARD_PREFIX.match
+
+    async def send_event(frame: str):
+        """Send a JSON event frame in the client's wire format"""
+        if use_msgpack:
+            await websocket.send_bytes(ormsgpack.packb(orjson.loads(frame)))
+        else:
+            await websocket.send_text(frame)
 
-        async def relay_upstream_to_local():
+    async def write_client():
+        frame = None
+        while True:
+            if frame is None:
+                frame = await to_client.get()
+            if not isinstance(frame, bytes):
+                await send_event(frame)
+                frame = None
+                continue
+            # Raw PCM concatenates cleanly, so audio chunks that piled up
+            # while the last send was in flight go out as one message.
+            # A text frame found behind them is held and sent next, in order.
+            chunks = [frame]
+            size = len(frame)
+            frame = None
+            while size < AUDIO_COALESCE_BYTES and not to_client.empty():
+                nxt = to_client.get_nowait()
+                if not isinstance(nxt, bytes):
+                    frame = nxt
+                    break
+                chunks.append(nxt)
+                size += len(nxt)
+            audio = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+            if use_msgpack:
+                # Binary frames are all MessagePack here, so wrap the audio
+                await websocket.send_bytes(ormsgpack.packb({"type": "audio", "data": audio}))
+            else:
+                await websocket.send_bytes(audio)
+
+    async def relay_local_to_upstream():
+        nonlocal message_count
+        while True:
+            if use_msgpack:
+                try:
+                    data = ormsgpack.unpackb(await websocket.receive_bytes())
+                except ormsgpack.MsgpackDecodeError:
+                    data = None
+                if not isinstance(data, dict):
+                    await to_client.put(INVALID_MSGPACK_FRAME)
+                    continue
+            else:
+                data_str = await websocket.receive_text()
+                data = None
+            message_count += 1
+            if session_expired(websocket):
+                await close_expired_session(websocket)
+            if data is None:
+                # JSON frames that already carry an event id go upstream
+                # untouched; only the rest pay for a parse and re-serialize.
+                # A frame cut short can't end in "}", so it is parsed instead.
+                if match_raw_forward(data_str) and data_str.rstrip().endswith("}"):
+                    await upstream_send(data_str)
+                    continue
+                data = orjson.loads(data_str)
+            if "event_id" not in data:
+                relay._evt_seq += 1
+                data["event_id"] = f"{relay._evt_prefix}{relay._evt_seq:x}"
             try:
-                async for data_str in relay.upstream_ws:
-                    data = json.loads(data_str)
-                    # Handle binary audio data if present
-                    if data.get("type") == "audio" and "data" in data:
-                        audio_data = data["data"]
-                        # Send binary audio data as a binary websocket message
-                        await websocket.send_bytes(audio_data.encode('utf-8'))
-                    else:
-                        # Send other messages as text
-                        await websocket.send_text(data_str)
-            except websockets.ConnectionClosed:
-                pass
-
-        done, pending = await asyncio.wait(
-            [asyncio.create_task(relay_local_to_upstream()),
-             asyncio.create_task(relay_upstream_to_local())],
-            return_when=asyncio.FIRST_EXCEPTION
-        )
-        for task in pending:
-            task.cancel()
+                payload = orjson.dumps(data, default=_msgpack_default)
+            except orjson.JSONEncodeError:
+                # e.g. non-string map keys or ext types from a MessagePack client
+                await to_client.put(INVALID_MSGPACK_FRAME)
+                continue
+            # orjson's UTF-8 bytes still go out as a text frame
+            await upstream_send(payload, text=True)
 
-    except Exception as e:
-        logger.error(f"Relay error: {e}")
+    async def relay_upstream_to_local():
+        nonlocal message_count
+        while True:
+            # recv raises ConnectionClosed on any close, ending the group
+            data_str = await relay.upstream_ws.recv()
+            message_count += 1
+            # Only frames that mention "audio" can be audio events;
+            # everything else is forwarded verbatim without parsing
+            if _AUDIO_PROBE in data_str:
+                data = orjson.loads(data_str)
+                # Handle binary audio data if present
+                if data.get("type") == "audio" and "data" in data:
+                    # Decode the base64 payload once here and ship the raw
+                    # audio bytes as a binary websocket message
+                    await to_client.put(base64.b64decode(data["data"], validate=False))
+                    continue
+            # Send other messages as text
+            await to_client.put(data_str)
+
+    try:
+        # The first task to fail cancels the others
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(relay_local_to_upstream())
+            tg.create_task(relay_upstream_to_local())
+            tg.create_task(write_client())
+            tg.create_task(flush_metrics())
+    except* websockets.ConnectionClosed:
+        logger.info("Upstream connection closed")
+    except* WebSocketDisconnect as eg:
+        # Surface the bare exception so websocket_endpoint handles it as usual
+        raise eg.exceptions[0]
+    except* Exception as eg:
+        e = eg.exceptions[0]
+        logger.error("Relay error: %s", e)
         try:
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "error": {"message": str(e)}
-            }))
-        except:
+            await send_event(error_frame({"message": str(e)}))
+        except Exception:
             pass
+    finally:
+        flush_message_count()
 
 @web_app.post("/register", response_model=dict)
 async def register(user: UserCreate):
     """Register new user"""
-    db_user = get_user(user.email)
+    db_user = await asyncio.to_thread(get_user, user.email)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
-    user = create_user(user)
+    user = await create_user(user)
     return {"message": "User registered successfully"}
 
 @web_app.post("/token", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     """Login user and return access token"""
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -551,58 +870,83 @@ async def read_users_me(current_user: Annotated[UserInDB, Depends(get_current_us
 async def websocket_endpoint(websocket: WebSocket):
     """Handle WebSocket connections with proper lifecycle management"""
     relay = None
+    connected = False
+    # An optional JWT is verified once here; afterwards each message only
+    # checks the cached exp claim instead of re-verifying the signature.
+    # The token is optional, so this only ends sessions of clients that chose
+    # to authenticate; it does not gate access to the relay.
+    # Browsers can't set headers on a WebSocket, so it arrives as the
+    # subprotocol pair ["bearer", <jwt>] rather than in the URL, where it
+    # would end up in access logs and browser history.
+    subprotocols = websocket.scope.get("subprotocols", [])
+    access_token = subprotocol = None
+    if WS_AUTH_SUBPROTOCOL in subprotocols:
+        i = subprotocols.index(WS_AUTH_SUBPROTOCOL)
+        if i + 1 < len(subprotocols):
+            subprotocol, access_token = WS_AUTH_SUBPROTOCOL, subprotocols[i + 1]
+    if access_token:
+        from jose import JWTError, jwt
+        try:
+            websocket.state.claims = jwt.decode(access_token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
     try:
-        await manager.connect(websocket)
+        await manager.connect(websocket, subprotocol)
         monitor.increment('websocket_connections')
+        connected = True
         logger.info("New WebSocket connection accepted")
 
         # Send connection acknowledgment
-        await websocket.send_text(json.dumps({
-            "type": "connection.established",
-            "timestamp": str(datetime.now())
-        }))
+        await websocket.send_text(_ACK_TEMPLATE % datetime.now())
 
         while True:
             try:
                 # Wait for messages
                 data = await websocket.receive_text()
-                msg = json.loads(data)
+                if session_expired(websocket):
+                    await close_expired_session(websocket)
+                msg = orjson.loads(data)
 
                 if msg.get("type") == "init_session":
                     # Handle initialization
                     session_config = msg.get("session_config", {})
                     try:
-                        token = create_ephemeral_token.local(session_config)
-                        relay = RealtimeRelay(token, session_config)
+                        if relay:
+                            # A repeated init_session replaces the previous relay
+                            await relay.close()
+                            relay = None
+                        ephemeral_token = await create_ephemeral_token.local(session_config)
+                        relay = RealtimeRelay(ephemeral_token, session_config)
                         await relay.connect_upstream()
-                        await handle_client(websocket, relay)
+                        await handle_client(
+                            websocket, relay,
+                            wire_format=msg.get("wire_format", "json")
+                        )
+                    except WebSocketDisconnect:
+                        # The socket is gone; there is no one to report to
+                        raise
                     except Exception as e:
-                        await websocket.send_text(json.dumps({
-                            "type": "error",
-                            "error": {
-                                "code": "relay_init_failed",
-                                "message": str(e)
-                            }
+                        await websocket.send_text(error_frame({
+                            "code": "relay_init_failed",
+                            "message": str(e)
                         }))
                 else:
                     # Handle regular messages
-                    await websocket.send_text(json.dumps({
-                        "type": "message",
-                        "sender": "Server",
-                        "text": f"Received: {msg.get('text', '')}"
-                    }))
-            except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "error": {"message": "Invalid JSON message"}
-                }))
+                    # orjson is only used to escape the untrusted text
+                    text_json = orjson.dumps(f"Received: {msg.get('text', '')}").decode()
+                    await websocket.send_text(_ECHO_TEMPLATE % text_json)
+            except orjson.JSONDecodeError:
+                await websocket.send_text(INVALID_JSON_FRAME)
 
     except WebSocketDisconnect:
         logger.info("Client disconnected normally")
-        monitor.decrement('websocket_connections')
     except Exception as e:
-        logger.error(f"WebSocket error: {str(e)}")
+        logger.error("WebSocket error: %s", e)
     finally:
+        if connected:
+            monitor.decrement('websocket_connections')
+        manager.disconnect(websocket)
         if relay:
             await relay.close()
         logger.info("Cleaning up WebSocket connection")
@@ -626,14 +970,16 @@ def init_db():
         """)
         conn.commit()
 
+# Relaying is GIL-bound (JSON, dict work), so cap connections per container
+# and let Modal add containers instead of piling sessions onto one CPU
 @app.function(
     image=image,
-    keep_warm=1,
-    allow_concurrent_inputs=True,
+    min_containers=2,
     timeout=600,
-    container_idle_timeout=300,
+    scaledown_window=300,
     secrets=[Secret.from_name("distributed-systems")]
 )
+@concurrent(max_inputs=50)
 @asgi_app(label="realtime-relay")
 def fastapi_app():
     """ASGI app for handling WebSocket connections"""
@@ -643,6 +989,9 @@ def fastapi_app():
     # Initialize database tables
     init_db()
     
+    # Compile chat.html now rather than on the first GET /
+    templates.get_template("chat.html")
+    
     # Initialize connection pool and monitoring
     global connection_pool
     connection_pool = ConnectionPool()
@@ -661,8 +1010,9 @@ def fastapi_app():
             "status": "healthy",
             "timestamp": datetime.now().isoformat(),
             "version": "1.0.0",
-            "connections": len(connection_pool.pool),
+            "connections": connection_pool.size,
             "queue_size": connection_pool.queue.qsize(),
+            "relays": relay_stats(),
             "websocket_stats": {
                 "connections": stats["websocket_connections"],
                 "messages": stats["websocket_messages"],
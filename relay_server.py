@@ -2,16 +2,20 @@
 # | relay_server.py                         |
 # +-----------------------------------------+
 import os
-import json
+import re
+import orjson
 import asyncio
 import websockets
-import requests
-import uuid
+import aiohttp
+import secrets
+import itertools
 from typing import Optional
 
 # Import Modal mount and other dependencies
 from modal import Mount
 
+from token_retry import RETRYABLE_STATUSES, TOKEN_MAX_ATTEMPTS, backoff_delay
+
 # from tool_registry import ToolRegistry, Tool
 
 ################################################################################
@@ -50,10 +54,37 @@ tool_registry = None
 # The port on which our local relay will listen for the CLI:
 LOCAL_SERVER_PORT = 9000
 
+# Upstream Realtime endpoint. Point it at a local egress proxy
+# (e.g. ws://127.0.0.1:8081/v1/realtime) to keep TLS out of this process.
+REALTIME_URL = os.environ.get("OPENAI_REALTIME_URL", "wss://api.openai.com/v1/realtime")
+
+# Concurrent client sessions; further clients wait for a free slot
+MAX_CLIENTS = int(os.environ.get("RELAY_MAX_CLIENTS", "64"))
+client_slots = asyncio.Semaphore(MAX_CLIENTS)
+
+# Concurrent session setups against OpenAI (token POST + upstream handshake),
+# so a burst of clients doesn't stampede the API all at once
+MAX_OPENAI_SETUPS = int(os.environ.get("RELAY_MAX_OPENAI_SETUPS", "32"))
+openai_setup_slots = asyncio.Semaphore(MAX_OPENAI_SETUPS)
+
+# Shared session so ephemeral token requests reuse one keep-alive
+# connection to api.openai.com instead of a TLS handshake per client.
+# Opened in main(), since aiohttp sessions belong to a running loop.
+http_session: Optional[aiohttp.ClientSession] = None
+
 ################################################################################
 # Helper: Create ephemeral token
 ################################################################################
 
+# Session config fields accepted by the /v1/realtime/sessions endpoint
+ALLOWED_SESSION_KEYS = frozenset({
+    "model", "modalities", "instructions", "voice",
+    "input_audio_format", "output_audio_format",
+    "input_audio_transcription", "turn_detection",
+    "tools", "tool_choice", "temperature",
+    "max_response_output_tokens"
+})
+
 async def initialize_tool_registry():
     # """Initialize and load tools from the registry"""
     # try:
@@ -70,17 +101,8 @@ async def create_ephemeral_token(session_config: dict) -> str:
     Strips out any non-supported fields from session config.
     """
     # Only include supported fields
-    payload = {
-        k: session_config[k] 
-        for k in [
-            "model", "modalities", "instructions", "voice",
-            "input_audio_format", "output_audio_format",
-            "input_audio_transcription", "turn_detection",
-            "tools", "tool_choice", "temperature",
-            "max_response_output_tokens"
-        ]
-        if k in session_config
-    }
+    # Key-view intersection is a C-level set op over the smaller side
+    payload = {k: session_config[k] for k in session_config.keys() & ALLOWED_SESSION_KEYS}
     
     url = "https://api.openai.com/v1/realtime/sessions"
     headers = {
@@ -89,16 +111,99 @@ async def create_ephemeral_token(session_config: dict) -> str:
         "OpenAI-Beta": "realtime=v1"
     }
     
-    resp = requests.post(url, headers=headers, json=payload)
-    if resp.status_code != 200:
-        raise RuntimeError(f"Failed ephemeral token: {resp.text}")
-    data = resp.json()
-    return data["client_secret"]["value"]
+    body = orjson.dumps(payload)
+    for attempt in range(TOKEN_MAX_ATTEMPTS):
+        # Hold a setup slot for the POST only, never across the backoff sleep
+        async with openai_setup_slots:
+            async with http_session.post(url, headers=headers, data=body) as resp:
+                if resp.status == 200:
+                    data = await resp.json(loads=orjson.loads)
+                    return data["client_secret"]["value"]
+                if resp.status not in RETRYABLE_STATUSES or attempt == TOKEN_MAX_ATTEMPTS - 1:
+                    raise RuntimeError(f"Failed ephemeral token: {await resp.text()}")
+                retry_after = resp.headers.get("Retry-After")
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+################################################################################
+# Upstream frame probes
+################################################################################
+
+# Frames buffered for the local client before the upstream reader waits
+OUTBOUND_QUEUE_SIZE = 256
+
+# Quoted values that must appear in any upstream frame the relay inspects.
+# Frames matching none of them (the bulk: deltas) are forwarded unparsed.
+UPSTREAM_INSPECT_PROBES = (b'"rate_limits.updated"', b'"session.created"', b'"error"')
+
+# A client frame whose leading keys are a top-level event_id and type (in
+# either order) needs no changes unless it is a function call, so it is
+# forwarded upstream as the bytes received. Anchoring on the leading keys
+# keeps a type nested inside e.g. "item" from passing for a top-level one.
+_RAW_FORWARD_PREFIX = re.compile(
+    rb'\s*\{\s*(?:"event_id"\s*:\s*"[^"\\]*"\s*,\s*"type"\s*:\s*"([^"\\]*)"'
+    rb'|"type"\s*:\s*"([^"\\]*)"\s*,\s*"event_id"\s*:\s*"[^"\\]*")'
+)
+
+################################################################################
+# Pre-serialized events
+################################################################################
+
+def prebuild_error_event(error: dict) -> str:
+    """
+    Serialize a fixed error event once, leaving a %s slot for its event_id.
+    """
+    body = orjson.dumps({"type": "error", "error": error}).decode()
+    return '{"event_id":"%s",' + body[1:].replace("%", "%%")
+
+INVALID_INIT_EVENT = prebuild_error_event({
+    "type": "invalid_request_error",
+    "code": "invalid_event",
+    "message": "First message must have type=init_session",
+    "param": "type"
+})
+
+MISSING_TYPE_EVENT = prebuild_error_event({
+    "type": "invalid_request_error",
+    "code": "invalid_event",
+    "message": "The 'type' field is missing",
+    "param": "type"
+})
+
+SERVER_ERROR_TEMPLATE = '{"type":"server_relay_error","error":%s}'
+
+# Error events with a variable message: only the message needs escaping
+ERROR_EVENT_TEMPLATE = (
+    '{"event_id":"%s","type":"error","error":'
+    '{"type":"%s","code":"%s","message":%s,"param":null}}'
+)
+
+def error_event(event_id: str, error_type: str, code: str, message: str) -> str:
+    return ERROR_EVENT_TEMPLATE % (event_id, error_type, code, orjson.dumps(message).decode())
+
+INVALID_JSON_EVENT = prebuild_error_event({
+    "type": "invalid_request_error",
+    "code": "invalid_json",
+    "message": "Invalid JSON payload",
+    "param": None
+})
 
 ################################################################################
 # Relay Connection
 ################################################################################
 
+# websockets.connect options for the OpenAI upstream. Frames are JSON text
+# and base64 audio, so permessage-deflate costs CPU for little gain.
+UPSTREAM_CONNECT_OPTIONS = {
+    "compression": None,
+    # Room for large audio deltas, and fewer drain() waits on bursts
+    "max_size": 2**24,
+    "write_limit": 2**20,
+    # Keepalive every 30s is plenty for a socket that streams continuously
+    "ping_interval": 30,
+    "ping_timeout": 30,
+    "close_timeout": 5,
+}
+
 class RealtimeRelay:
     """
     Manages a single upstream connection to the OpenAI Realtime API.
@@ -109,39 +214,74 @@ class RealtimeRelay:
         self.ephemeral_token = ephemeral_token
         self.session_config = session_config
         self.upstream_ws = None  # websockets.client.WebSocketClientProtocol
+        self.rate_limits = None
+        # Everything bound for the local client goes through one writer
+        self.out_q: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        # Event ids: random per-relay prefix plus a counter, no RNG per message
+        self._evt_prefix = f"evt_{secrets.token_hex(3)}_"
+        self._evt_ctr = itertools.count(1)
+        # The URL and headers are fixed for the relay's lifetime, so build
+        # them once rather than on every (re)connect.
+        # If session_config includes "model", the ephemeral session is
+        # already locked to it; passing it in the URL again is for safety.
+        model = session_config.get("model", None)
+        self._url = f"{REALTIME_URL}?model={model}" if model else REALTIME_URL
+        self._headers = {
+            "Authorization": f"Bearer {ephemeral_token}",
+            "OpenAI-Beta": "realtime=v1"
+        }
+
+    def next_event_id(self) -> str:
+        return f"{self._evt_prefix}{next(self._evt_ctr):x}"
 
     async def connect_upstream(self):
         """
         Connect to the Realtime API over WebSocket using ephemeral token.
         """
-        # Build the Realtime wss URL
-        # We can append "?model=..." if not specified in the session config.
-        # But if session_config includes "model", the ephemeral session should
-        # already be locked to that model. It's optional to pass again in the URL.
-        base_url = "wss://api.openai.com/v1/realtime"
-        # For safety, specify the model if we know it:
-        model = self.session_config.get("model", None)
-        if model:
-            base_url += f"?model={model}"
-
-        headers = {
-            "Authorization": f"Bearer {self.ephemeral_token}",
-            "OpenAI-Beta": "realtime=v1"
-        }
-
-        print(f"Connecting upstream to {base_url} ...")
-        self.upstream_ws = await websockets.connect(base_url, additional_headers=headers)
+        print(f"Connecting upstream to {self._url} ...")
+        self.upstream_ws = await websockets.connect(
+            self._url,
+            additional_headers=self._headers,
+            **UPSTREAM_CONNECT_OPTIONS
+        )
         print("Upstream connected.")
 
     async def close(self):
         if self.upstream_ws:
             await self.upstream_ws.close()
 
+################################################################################
+# Upstream event handlers
+################################################################################
+
+def on_rate_limits_updated(relay: RealtimeRelay, data: dict):
+    relay.rate_limits = data.get("rate_limits", [])
+
+def on_session_created(relay: RealtimeRelay, data: dict):
+    print(f"Session created with config: {data.get('session', {})}")
+
+def on_error(relay: RealtimeRelay, data: dict):
+    print(f"Error from OpenAI: {data.get('error', {}).get('message', 'Unknown error')}")
+
+# Upstream event type -> handler; one dict lookup per inspected frame
+UPSTREAM_HANDLERS = {
+    "rate_limits.updated": on_rate_limits_updated,
+    "session.created": on_session_created,
+    "error": on_error,
+}
+
 ################################################################################
 # Relay server: local <-> Realtime
 ################################################################################
 
 async def handle_client(client_ws):
+    """
+    Runs a client session once one of the MAX_CLIENTS slots is free.
+    """
+    async with client_slots:
+        await relay_client(client_ws)
+
+async def relay_client(client_ws):
     """
     Handles a single local client that connects to the relay server.
     1. Expects first message to contain the desired session config (JSON).
@@ -155,177 +295,157 @@ async def handle_client(client_ws):
     try:
         # Step 1: Wait for session init from local
         init_msg_str = await client_ws.recv()
-        init_msg = json.loads(init_msg_str)
+        init_msg = orjson.loads(init_msg_str)
         
         if init_msg.get("type") != "init_session":
-            error_event = {
-                "event_id": f"evt_{uuid.uuid4().hex[:6]}",
-                "type": "error",
-                "error": {
-                    "type": "invalid_request_error",
-                    "code": "invalid_event",
-                    "message": "First message must have type=init_session",
-                    "param": "type"
-                }
-            }
-            await client_ws.send(json.dumps(error_event))
+            await client_ws.send(INVALID_INIT_EVENT % f"evt_{secrets.token_hex(3)}")
             return
 
         session_config = init_msg.get("session_config", {})
         try:
             ephemeral_token = await create_ephemeral_token(session_config)
         except Exception as e:
-            error_event = {
-                "event_id": f"evt_{uuid.uuid4().hex[:6]}",
-                "type": "error",
-                "error": {
-                    "type": "token_error",
-                    "code": "token_creation_failed",
-                    "message": str(e),
-                    "param": None
-                }
-            }
-            await client_ws.send(json.dumps(error_event))
+            await client_ws.send(error_event(
+                f"evt_{secrets.token_hex(3)}", "token_error", "token_creation_failed", str(e)
+            ))
             return
 
         relay = RealtimeRelay(ephemeral_token, session_config)
-        await relay.connect_upstream()
+        async with openai_setup_slots:
+            await relay.connect_upstream()
 
         # Load and format available tools
         session_config["tools"] = []  # Initialize empty tools list
         
-        # Step 2: Start bi-directional relay
+        # Step 2: Start bi-directional relay. The per-frame loops only
+        # touch these locals, not attribute chains or module globals.
+        out_q = relay.out_q
+        put_local = out_q.put
+        recv_local = client_ws.recv
+        send_local = client_ws.send
+        upstream_send = relay.upstream_ws.send
+        next_event_id = relay.next_event_id
+        loads = orjson.loads
+        dumps = orjson.dumps
+        match_raw_forward = _RAW_FORWARD_PREFIX.match
+
+        async def write_local():
+            """
+            Single writer for the local client. Frames are JSON str or
+            UTF-8 bytes; both go out as text frames, and bytes are sent
+            without a decode/encode round trip.
+            """
+            while True:
+                await send_local(await out_q.get(), text=True)
+                # Send what queued up during that send without re-waiting
+                while not out_q.empty():
+                    await send_local(out_q.get_nowait(), text=True)
+
         async def relay_local_to_upstream():
             """
             For every message from the local CLI, forward it upstream.
             """
             while True:
                 try:
-                    data_str = await client_ws.recv()
-                    data = json.loads(data_str)
+                    # Raw bytes: orjson parses UTF-8 directly, no str decode
+                    data_bytes = await recv_local(decode=False)
+                    # A frame cut short can't end in "}"; it falls through
+                    # to the parse and gets INVALID_JSON_EVENT
+                    if ((m := match_raw_forward(data_bytes))
+                            and (m[1] or m[2]) != b"function.call"
+                            and data_bytes.rstrip().endswith(b"}")):
+                        await upstream_send(data_bytes, text=True)
+                        continue
+                    data = loads(data_bytes)
                     
                     # Ensure event_id exists
                     if "event_id" not in data:
-                        data["event_id"] = f"evt_{uuid.uuid4().hex[:6]}"
+                        data["event_id"] = next_event_id()
                     
                     # Validate event type
                     if "type" not in data:
-                        error_event = {
-                            "event_id": f"evt_{uuid.uuid4().hex[:6]}",
-                            "type": "error",
-                            "error": {
-                                "type": "invalid_request_error",
-                                "code": "invalid_event",
-                                "message": "The 'type' field is missing",
-                                "param": "type"
-                            }
-                        }
-                        await client_ws.send(json.dumps(error_event))
+                        await put_local(MISSING_TYPE_EVENT % next_event_id())
                         continue
 
                     # Handle function calls
                     if data.get("type") == "function.call":
                         try:
                             response = {
-                                "event_id": f"evt_{uuid.uuid4().hex[:6]}",
+                                "event_id": next_event_id(),
                                 "type": "function.response",
                                 "response_id": data.get("response_id"),
                                 "result": {"error": "Function calls not implemented"}
                             }
-                            await client_ws.send(json.dumps(response))
+                            await put_local(dumps(response))
                         except Exception as e:
-                            error = {
-                                "event_id": f"evt_{uuid.uuid4().hex[:6]}",
-                                "type": "error",
-                                "error": {
-                                    "type": "function_error",
-                                    "code": "function_call_failed",
-                                    "message": str(e)
-                                }
-                            }
-                            await client_ws.send(json.dumps(error))
+                            await put_local(error_event(
+                                next_event_id(), "function_error", "function_call_failed", str(e)
+                            ))
                     else:
-                        await relay.upstream_ws.send(json.dumps(data))
-                except json.JSONDecodeError:
-                    error_event = {
-                        "event_id": f"evt_{uuid.uuid4().hex[:6]}",
-                        "type": "error",
-                        "error": {
-                            "type": "invalid_request_error",
-                            "code": "invalid_json",
-                            "message": "Invalid JSON payload",
-                            "param": None
-                        }
-                    }
-                    await client_ws.send(json.dumps(error_event))
+                        # orjson returns UTF-8 bytes; keep them a text frame
+                        await upstream_send(dumps(data), text=True)
+                except orjson.JSONDecodeError:
+                    await put_local(INVALID_JSON_EVENT % next_event_id())
 
         async def relay_upstream_to_local():
             """
             For every message from the Realtime API, forward it to the local client.
             """
-            rate_limits = None
+            handlers = UPSTREAM_HANDLERS
             try:
-                async for data_str in relay.upstream_ws:
-                    data = json.loads(data_str)
-                    
-                    # Track rate limits
-                    if data.get("type") == "rate_limits.updated":
-                        rate_limits = data.get("rate_limits", [])
-                        
-                    # Handle session creation
-                    elif data.get("type") == "session.created":
-                        print(f"Session created with config: {data.get('session', {})}")
-                        
-                    # Handle errors
-                    elif data.get("type") == "error":
-                        print(f"Error from OpenAI: {data.get('error', {}).get('message', 'Unknown error')}")
-                        
-                    await client_ws.send(data_str)
+                recv_upstream = relay.upstream_ws.recv
+                while True:
+                    # Keep text frames as their UTF-8 bytes: they are
+                    # forwarded as-is, so decoding to str is wasted work
+                    data_bytes = await recv_upstream(decode=False)
+                    # Forward first; inspection never changes the frame
+                    await put_local(data_bytes)
+                    if not any(probe in data_bytes for probe in UPSTREAM_INSPECT_PROBES):
+                        continue
+                    data = loads(data_bytes)
+                    handler = handlers.get(data.get("type"))
+                    if handler is not None:
+                        handler(relay, data)
                     
             except websockets.ConnectionClosed:
                 pass
             except Exception as e:
-                error_event = {
-                    "event_id": f"evt_{uuid.uuid4().hex[:6]}",
-                    "type": "error",
-                    "error": {
-                        "type": "relay_error",
-                        "code": "relay_failed",
-                        "message": str(e),
-                        "param": None
-                    }
-                }
-                try:
-                    await client_ws.send(json.dumps(error_event))
-                except:
-                    pass
-
-        done, pending = await asyncio.wait(
-            [asyncio.create_task(relay_local_to_upstream()),
-             asyncio.create_task(relay_upstream_to_local())],
-            return_when=asyncio.FIRST_EXCEPTION
-        )
-        # If any subtask fails, cancel the other
-        for task in pending:
-            task.cancel()
+                await put_local(error_event(
+                    next_event_id(), "relay_error", "relay_failed", str(e)
+                ))
+
+        try:
+            # The first task to fail cancels the others
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(relay_local_to_upstream())
+                tg.create_task(relay_upstream_to_local())
+                tg.create_task(write_local())
+        except* websockets.ConnectionClosed:
+            pass
+        except* Exception as eg:
+            # Surface the real error to the handler below, not the group
+            raise eg.exceptions[0]
 
     except (asyncio.CancelledError, websockets.ConnectionClosed):
         pass
     except Exception as e:
         print(f"[Server Error] {e}")
         # Attempt to inform the client
-        err_evt = {
-            "type": "server_relay_error",
-            "error": str(e)
-        }
         try:
-            await client_ws.send(json.dumps(err_evt))
+            await client_ws.send(SERVER_ERROR_TEMPLATE % orjson.dumps(str(e)).decode())
         except:
             pass
     finally:
+        if relay:
+            await relay.close()
         await client_ws.close()
 
 async def main():
+    global http_session
+    # Python 3.12+: run new tasks eagerly up to their first real await,
+    # skipping a scheduler round trip for ones that finish synchronously
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
     # Initialize Tool Registry
     await initialize_tool_registry()
     
@@ -348,11 +468,27 @@ Relay Server implementation - OpenAI Realtime API
           """)
     print("\n")
     print(f"Relay server started on ws://localhost:{LOCAL_SERVER_PORT}")
-    async with websockets.serve(handle_client, "localhost", LOCAL_SERVER_PORT, compression=None):
-        await asyncio.Future()  # run forever
+    connector = aiohttp.TCPConnector(limit=64, keepalive_timeout=75)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=10)
+    ) as http_session:
+        # Liveness comes from ping/pong, not from timeouts around each recv/send
+        async with websockets.serve(
+            handle_client, "localhost", LOCAL_SERVER_PORT,
+            compression=None, ping_interval=20, ping_timeout=20,
+            max_size=2**24, write_limit=2**20
+        ):
+            await asyncio.Future()  # run forever
 
 if __name__ == "__main__":
+    # uvloop is optional; it speeds up socket I/O when installed
+    try:
+        import uvloop
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         print("Relay server shutting down.")
@@ -1,5 +1,9 @@
+import asyncio
 import openai
-from typing import List, Dict, Any, Optional
+import httpx
+import numpy as np
+import re
+from typing import List, Dict, Any, Optional, Tuple
 from models.thought_process import ChainOfThought, ThoughtStep, Metadata, ThoughtCategory
 import logging
 import json
@@ -7,18 +11,91 @@ from models.pricing import ModelType
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.92
+
+# Realtime indicator categories; any two suggest realtime interaction
+_INTERACTIVE = re.compile(r"interact|conversation", re.I)
+_CONTINUOUS = re.compile(r"continuous|ongoing", re.I)
+_STREAMING = re.compile(r"stream|real-time", re.I)
+_AUDIO = re.compile(r"audio|voice", re.I)
+REALTIME_INDICATORS = (_INTERACTIVE, _CONTINUOUS, _STREAMING, _AUDIO)
+
+class SemanticCache:
+    """Bounded embedding-similarity cache of analyzed prompts and their ChainOfThought"""
+
+    def __init__(self, threshold: float = SIMILARITY_THRESHOLD, capacity: int = 1024):
+        self.threshold = threshold
+        self.capacity = capacity
+        self._embeddings: Optional[np.ndarray] = None
+        self._size = 0
+        self._next = 0  # Slot overwritten next once full (oldest entry)
+        self.prompts: List[Optional[str]] = [None] * capacity
+        self.responses: List[Optional[ChainOfThought]] = [None] * capacity
+        self._slots: Dict[str, int] = {}
+
+    def get(self, prompt: str) -> Optional[ChainOfThought]:
+        """Return the cached response for an identical prompt"""
+        slot = self._slots.get(prompt)
+        if slot is None:
+            return None
+        return self.responses[slot].model_copy(deep=True)
+
+    def lookup(self, embedding: np.ndarray) -> Optional[ChainOfThought]:
+        """Return the cached response closest to embedding if above threshold"""
+        if not self._size:
+            return None
+        scores = self._embeddings[:self._size] @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] > self.threshold:
+            return self.responses[best].model_copy(deep=True)
+        return None
+
+    def add(self, embedding: np.ndarray, prompt: str, response: ChainOfThought):
+        if prompt in self._slots:
+            return
+        if self._embeddings is None:
+            self._embeddings = np.empty((self.capacity, embedding.shape[0]), dtype=np.float32)
+        slot = self._next
+        evicted = self.prompts[slot]
+        if evicted is not None:
+            del self._slots[evicted]
+        self._embeddings[slot] = embedding
+        self.prompts[slot] = prompt
+        self.responses[slot] = response.model_copy(deep=True)
+        self._slots[prompt] = slot
+        self._next = (slot + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def save(self, path: str):
+        """Write embeddings to {path}.npy and prompts/responses to {path}.json"""
+        order = [(self._next + i) % self.capacity for i in range(self.capacity)]
+        order = [slot for slot in order if self.prompts[slot] is not None]
+        embeddings = (self._embeddings[order] if order
+                      else np.empty((0, 0), dtype=np.float32))
+        np.save(f"{path}.npy", embeddings, allow_pickle=False)
+        with open(f"{path}.json", "w") as f:
+            json.dump([
+                {"prompt": self.prompts[slot], "response": self.responses[slot].model_dump(mode="json")}
+                for slot in order
+            ], f)
+
+    def load(self, path: str):
+        embeddings = np.load(f"{path}.npy", allow_pickle=False)
+        with open(f"{path}.json") as f:
+            entries = json.load(f)
+        self._embeddings = None
+        self._size = self._next = 0
+        self.prompts = [None] * self.capacity
+        self.responses = [None] * self.capacity
+        self._slots = {}
+        for embedding, entry in zip(embeddings, entries):
+            self.add(embedding, entry["prompt"], ChainOfThought.model_validate(entry["response"]))
+
 class ThoughtAnalyzer:
     """Analyzes user queries using chain of thought reasoning"""
-    
-    def __init__(self):
-        import os
-        self.api_key = os.getenv("OPENAI_API_KEY")
-        openai.api_key = self.api_key
-        
-    async def analyze_query(self, query: str, context: Optional[Dict[str, Any]] = None) -> ChainOfThought:
-        """Analyze a user query using chain of thought reasoning"""
-        
-        system_prompt = """
+
+    SYSTEM_PROMPT = """
         You are an expert AI system analyzer. Break down user queries into clear reasoning steps.
         For each step:
         1. Provide detailed reasoning
@@ -35,83 +112,155 @@ class ThoughtAnalyzer:
         
         Structure your response as a formal chain of thought analysis.
         """
+    
+    def __init__(self, speculative_completion: bool = False):
+        """
+        With speculative_completion, the chat completion is sent while the
+        prompt is still being embedded, so a semantic-cache miss costs no
+        extra round trip; on a hit that request is cancelled but may already
+        be billed. Off by default.
+        """
+        import os
+        self.speculative_completion = speculative_completion
+        self.api_key = os.getenv("OPENAI_API_KEY")
+        openai.api_key = self.api_key
+        self._client = openai.AsyncOpenAI(
+            api_key=self.api_key,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+                timeout=30.0
+            )
+        )
+        self.cache = SemanticCache()
+
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self._client.close()
+
+    async def _embed(self, text: str) -> np.ndarray:
+        """Embed text and L2-normalize it for cosine similarity"""
+        response = await self._client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return embedding / np.linalg.norm(embedding)
+        
+    async def analyze_query(self, query: str, context: Optional[Dict[str, Any]] = None) -> ChainOfThought:
+        """Analyze a user query using chain of thought reasoning"""
         
-        # Include context in prompt if provided
-        user_prompt = query
+        messages = [{"role": "system", "content": self.SYSTEM_PROMPT}]
+        cache_key = query
+        # Context goes in its own message after the static prefix
         if context:
-            user_prompt = f"Context:\n{json.dumps(context)}\n\nQuery:\n{query}"
+            context_prompt = f"Context:\n{json.dumps(context, sort_keys=True)}"
+            messages.append({"role": "system", "content": context_prompt})
+            cache_key = f"{context_prompt}\n\nQuery:\n{query}"
+        messages.append({"role": "user", "content": query})
         
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+            
+        completion = None
         try:
-            response = await openai.AsyncOpenAI().beta.chat.completions.parse(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,
-                response_format=ChainOfThought
-            )
+            if self.speculative_completion:
+                completion = asyncio.create_task(self._complete(messages))
+            embedding = None
+            try:
+                embedding = await self._embed(cache_key)
+            except Exception as e:
+                logger.warning(f"Skipping semantic cache, embedding failed: {str(e)}")
+            if embedding is not None:
+                cached = self.cache.lookup(embedding)
+                if cached is not None:
+                    return cached
+                    
+            response = await (completion or self._complete(messages))
             
             # Parse the response into structured format
             content = response.choices[0].message.parsed
+            self._apply_step_analysis(content)
             print(json.dumps(content.dict(), indent=2))
+            if embedding is not None:
+                self.cache.add(embedding, cache_key, content)
             return content
             
         except Exception as e:
             logger.error(f"Error analyzing query: {str(e)}")
             raise
-        
-    def _calculate_complexity(self, steps: List[ThoughtStep]) -> int:
-        """Calculate overall complexity score"""
-        if not steps:
-            return 1
             
-        factors = {
-            "num_steps": len(steps),
-            "avg_confidence": sum(s.confidence for s in steps) / len(steps),
-            "tool_requirements": sum(1 for s in steps if s.requires_tools),
-            "technical_steps": sum(1 for s in steps if s.category == ThoughtCategory.TECHNICAL)
-        }
-        
-        # Weight and combine factors
-        complexity = (
-            factors["num_steps"] * 0.3 +
-            (1 - factors["avg_confidence"]) * 0.3 +
-            factors["tool_requirements"] * 0.2 +
-            factors["technical_steps"] * 0.2
+        finally:
+            if completion is not None and not completion.done():
+                completion.cancel()
+                
+    def _complete(self, messages: List[Dict[str, str]]):
+        """Start the structured chain-of-thought completion"""
+        return self._client.beta.chat.completions.parse(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.7,
+            response_format=ChainOfThought
         )
         
-        # Scale to 1-10 range
-        return max(1, min(10, int(complexity * 2 + 1)))
+    def _analyze_steps(self, steps: List[ThoughtStep]) -> Tuple[int, bool, bool]:
+        """Compute complexity, realtime need and audio flag in one pass over steps.
+        Callers needing more than one of them run this once and pass the result
+        to the helpers below."""
+        num_steps = len(steps)
+        confidence_sum = 0.0
+        tool_requirements = 0
+        technical_steps = 0
+        indicators = set()
+        has_audio = False
         
-    def _requires_realtime(self, steps: List[ThoughtStep]) -> bool:
-        """Determine if realtime interaction is needed"""
-        if not steps:
-            return True
+        for step in steps:
+            confidence_sum += step.confidence
+            if step.requires_tools:
+                tool_requirements += 1
+            reasoning = step.reasoning
+            for pattern in REALTIME_INDICATORS:
+                if pattern not in indicators and pattern.search(reasoning):
+                    indicators.add(pattern)
+            if step.category == ThoughtCategory.TECHNICAL:
+                technical_steps += 1
+                if not has_audio and _AUDIO.search(reasoning):
+                    has_audio = True
+                    
+        if num_steps:
+            # Weight and combine factors
+            complexity = (
+                num_steps * 0.3 +
+                (1 - confidence_sum / num_steps) * 0.3 +
+                tool_requirements * 0.2 +
+                technical_steps * 0.2
+            )
+            # Scale to 1-10 range
+            complexity = max(1, min(10, int(complexity * 2 + 1)))
+            # If any two indicators are present, suggest realtime
+            requires_realtime = len(indicators) >= 2
+        else:
+            complexity = 1
+            requires_realtime = True
             
-        # Check for indicators that realtime is needed
-        realtime_indicators = {
-            "interactive": False,
-            "continuous": False,
-            "streaming": False,
-            "audio": False
-        }
+        return complexity, requires_realtime, has_audio
         
-        for step in steps:
-            lower_reasoning = step.reasoning.lower()
-            if "interact" in lower_reasoning or "conversation" in lower_reasoning:
-                realtime_indicators["interactive"] = True
-            if "continuous" in lower_reasoning or "ongoing" in lower_reasoning:
-                realtime_indicators["continuous"] = True
-            if "stream" in lower_reasoning or "real-time" in lower_reasoning:
-                realtime_indicators["streaming"] = True
-            if "audio" in lower_reasoning or "voice" in lower_reasoning:
-                realtime_indicators["audio"] = True
-                
-        # If any two indicators are True, suggest realtime
-        return sum(realtime_indicators.values()) >= 2
+    def _apply_step_analysis(self, thought: ChainOfThought):
+        """Derive complexity, realtime need and models from the steps in one pass"""
+        analysis = self._analyze_steps(thought.steps)
+        thought.estimated_complexity = self._calculate_complexity(thought.steps, analysis)
+        thought.requires_realtime = self._requires_realtime(thought.steps, analysis)
+        thought.suggested_models = self._suggest_models(thought, analysis)
+        
+    def _calculate_complexity(self, steps: List[ThoughtStep],
+                              analysis: Optional[Tuple[int, bool, bool]] = None) -> int:
+        """Calculate overall complexity score"""
+        return (analysis or self._analyze_steps(steps))[0]
         
-    def _suggest_models(self, thought: ChainOfThought) -> List[str]:
+    def _requires_realtime(self, steps: List[ThoughtStep],
+                           analysis: Optional[Tuple[int, bool, bool]] = None) -> bool:
+        """Determine if realtime interaction is needed"""
+        return (analysis or self._analyze_steps(steps))[1]
+        
+    def _suggest_models(self, thought: ChainOfThought,
+                        analysis: Optional[Tuple[int, bool, bool]] = None) -> List[str]:
         """Suggest appropriate models based on analysis"""
         models = []
         
@@ -122,11 +271,7 @@ class ThoughtAnalyzer:
             models.append(ModelType.GPT4O_MINI_REALTIME.value)
             
         # Add audio model if needed
-        has_audio = any(
-            step.category == ThoughtCategory.TECHNICAL and
-            ("audio" in step.reasoning.lower() or "voice" in step.reasoning.lower())
-            for step in thought.steps
-        )
+        has_audio = (analysis or self._analyze_steps(thought.steps))[2]
         
         if has_audio:
             models.append(ModelType.GPT4O_REALTIME.value)
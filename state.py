@@ -2,10 +2,13 @@
 State management for the Realtime API client
 """
 from dataclasses import dataclass, field
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Deque
 from queue import Queue
 from enum import Enum
-from collections import defaultdict
+from collections import defaultdict, deque
+
+# How many recent events of each direction a session keeps for inspection
+EVENT_HISTORY_SIZE = 512
 
 class ResponseState(Enum):
     """Possible states for the response system"""
@@ -46,9 +49,9 @@ class SessionState:
     current_response_id: Optional[str] = None
     rate_limits: Dict[str, Dict[str, int]] = field(default_factory=dict)
     
-    # Track all events
-    events_received: List[Dict[str, Any]] = field(default_factory=list)
-    events_sent: List[Dict[str, Any]] = field(default_factory=list)
+    # Track recent events (bounded, so long sessions don't grow without limit)
+    events_received: Deque[Dict[str, Any]] = field(default_factory=lambda: deque(maxlen=EVENT_HISTORY_SIZE))
+    events_sent: Deque[Dict[str, Any]] = field(default_factory=lambda: deque(maxlen=EVENT_HISTORY_SIZE))
     
     # Track specific event counts
     event_counts: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
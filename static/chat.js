@@ -2,6 +2,8 @@ let ws;
 
 function connect() {
     ws = new WebSocket(`${window.location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}/ws`);
+    // Binary frames carry raw (already base64-decoded) audio bytes
+    ws.binaryType = 'arraybuffer';
     
     ws.onopen = () => {
         console.log('Connected to WebSocket');
@@ -17,6 +19,10 @@ function connect() {
     };
 
     ws.onmessage = (event) => {
+        if (event.data instanceof ArrayBuffer) {
+            // Raw audio; this text-only UI has no playback
+            return;
+        }
         const data = JSON.parse(event.data);
         if (data.type === 'response.text.delta') {
             appendMessage('Assistant', data.delta);
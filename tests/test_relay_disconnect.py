@@ -0,0 +1,90 @@
+"""The Modal relay's /ws endpoint must release its connection gauge however a
+relayed session ends."""
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("modal")
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import realtime_relay_modal_app as relay_app
+
+
+class FakeUpstream:
+    """Stands in for the OpenAI websocket: idle until the relay closes it."""
+
+    def __init__(self, relaying: threading.Event):
+        self.relaying = relaying
+        self.close_code = None
+
+    async def send(self, frame, text=False):
+        pass
+
+    async def recv(self):
+        self.relaying.set()
+        # Never yields a frame; the relay's TaskGroup cancels this wait
+        await asyncio.Event().wait()
+
+    async def close(self):
+        self.close_code = 1000
+
+
+@pytest.fixture
+def relaying(monkeypatch):
+    relaying = threading.Event()
+
+    async def fake_token(session_config):
+        return "ek_test"
+
+    async def fake_connect(self):
+        self.upstream_ws = FakeUpstream(relaying)
+
+    monkeypatch.setattr(relay_app, "create_ephemeral_token", SimpleNamespace(local=fake_token))
+    monkeypatch.setattr(relay_app.RealtimeRelay, "connect_upstream", fake_connect)
+    monkeypatch.setitem(relay_app.monitor.metrics, "websocket_connections", 0)
+    return relaying
+
+
+def wait_for_gauge(value: int, timeout: float = 5.0) -> int:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        current = relay_app.monitor.metrics["websocket_connections"]
+        if current == value:
+            return current
+        time.sleep(0.01)
+    return relay_app.monitor.metrics["websocket_connections"]
+
+
+def start_session(ws, relaying: threading.Event):
+    ws.receive_text()  # connection.established
+    ws.send_text('{"type":"init_session","session_config":{}}')
+    assert relaying.wait(5), "relay never started"
+
+
+def test_client_disconnect_mid_relay_releases_gauge(relaying):
+    client = TestClient(relay_app.web_app)
+    with client.websocket_connect("/ws") as ws:
+        start_session(ws, relaying)
+        assert relay_app.monitor.metrics["websocket_connections"] == 1
+    assert wait_for_gauge(0) == 0
+    assert not relay_app.live_relays
+
+
+def test_expired_session_mid_relay_releases_gauge(relaying, monkeypatch):
+    client = TestClient(relay_app.web_app)
+    with client.websocket_connect("/ws") as ws:
+        start_session(ws, relaying)
+        monkeypatch.setattr(relay_app, "session_expired", lambda websocket: True)
+        ws.send_text('{"event_id":"evt_1","type":"response.create"}')
+        message = ws.receive()
+        assert message["type"] == "websocket.close"
+        assert message["code"] == relay_app.status.WS_1008_POLICY_VIOLATION
+    assert wait_for_gauge(0) == 0
+    assert not relay_app.live_relays
@@ -61,6 +61,7 @@ class TokenProcessor:
     def __init__(self):
         self.triggers: Dict[str, TokenTrigger] = {}
         self._buffer: List[str] = []
+        self._buffer_text = ""  # Always equal to " ".join(self._buffer)
         self._context_buffer: List[str] = []
         self.max_buffer_size = 1000
         self.max_context_size = 100
@@ -72,7 +73,6 @@ class TokenProcessor:
         
         # Advanced features
         self._middleware_manager = MiddlewareManager()
-        self._pattern_cache: Dict[str, Pattern] = {}
         self._trigger_metrics: Dict[str, Dict[str, float]] = defaultdict(dict)
         self._active_chains: List[asyncio.Task] = []
         self._backpressure_threshold = 0.8
@@ -152,35 +152,31 @@ class TokenProcessor:
             if len(self._buffer) / self.max_buffer_size > self._backpressure_threshold:
                 await asyncio.sleep(0.1)  # Apply backpressure
                 
+            if tokens:
+                added = " ".join(tokens)
+                self._buffer_text = f"{self._buffer_text} {added}" if self._buffer else added
             self._buffer.extend(tokens)
             self._context_buffer.extend(tokens)
             
             # Trim buffers
             if len(self._buffer) > self.max_buffer_size:
-                self._buffer = self._buffer[-self.max_buffer_size:]
+                self._drop_tokens(len(self._buffer) - self.max_buffer_size)
             if len(self._context_buffer) > self.max_context_size:
                 self._context_buffer = self._context_buffer[-self.max_context_size:]
                 
-            buffer_text = " ".join(self._buffer)
+            buffer_text = self._buffer_text
             
             # Process triggers with metrics
             for token in tokens:
                 start_time = time.time()
                 
-                # Check pattern cache
-                pattern_start = time.time()
-                for trigger_id, trigger in self.triggers.items():
-                    if trigger.pattern.pattern not in self._pattern_cache:
-                        self._pattern_cache[trigger.pattern.pattern] = trigger.pattern
-                pattern_time = time.time() - pattern_start
-                
                 # Execute trigger
                 trigger_start = time.time()
                 await self._process_single_token(token, context)
                 trigger_time = time.time() - trigger_start
                 
                 # Record metrics
-                metrics.record_token_processed(token, pattern_time, trigger_time)
+                metrics.record_token_processed(token, trigger_time)
                 
             # Apply post-processing middleware
             await self._middleware_manager.execute_chain(
@@ -269,7 +265,7 @@ class TokenProcessor:
                     
                     # Update buffer
                     token_count = len(ctx.matched_text.split())
-                    self._buffer = self._buffer[token_count:]
+                    self._drop_tokens(token_count)
                     
             except Exception as e:
                 logger.error(f"Error processing trigger: {e}")
@@ -277,6 +273,17 @@ class TokenProcessor:
     def clear_buffer(self) -> None:
         """Clear the token buffer"""
         self._buffer.clear()
+        self._buffer_text = ""
+        
+    def _drop_tokens(self, count: int) -> None:
+        """Drop the oldest tokens, slicing the joined buffer text to match"""
+        if count >= len(self._buffer):
+            self._buffer = []
+            self._buffer_text = ""
+            return
+        cut = sum(len(token) for token in self._buffer[:count]) + count
+        self._buffer = self._buffer[count:]
+        self._buffer_text = self._buffer_text[cut:]
         
     def disable_trigger(self, trigger_id: str) -> None:
         """Disable a specific trigger"""
@@ -0,0 +1,14 @@
+"""Retry policy for ephemeral Realtime token requests, shared by both relays."""
+import random
+from typing import Optional
+
+# Ephemeral token requests are retried on these statuses with jittered
+# exponential backoff, honouring Retry-After when OpenAI sends one
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+TOKEN_MAX_ATTEMPTS = 5
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait after failed attempt number `attempt` (from 0)"""
+    if retry_after and retry_after.isdigit():
+        return min(30, int(retry_after))
+    return min(30, 0.25 * 2 ** attempt + random.random() * 0.25)
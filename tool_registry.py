@@ -2,6 +2,7 @@ import os
 import json
 import logging
 import asyncio
+import time
 import httpx
 import uuid
 from typing import Dict, Any, List, Optional, Union, Literal
@@ -142,12 +143,8 @@ class Neo4jConnection:
             return
 
         uri = "neo4j://bolt.n4j.distributed.systems"
-        print(uri)
         user_ = os.getenv("NEO4J_USERNAME")
-
         pass_ = os.getenv("NEO4J_PASSWORD")
-        print(user_)
-        print(pass_)
 
         try:
             self.driver = GraphDatabase.driver(uri, auth=(user_, pass_))
@@ -166,13 +163,41 @@ class Neo4jConnection:
             return self.driver.session()
         return None
 
+# One driver per process: it pools Bolt connections itself, so building a
+# new one (and verifying connectivity) per request only adds handshakes
+_db: Optional[Neo4jConnection] = None
+
 async def get_db():
-    """Yields a new Neo4j connection; auto-closed after request."""
-    db = Neo4jConnection()
-    try:
-        yield db
-    finally:
-        await db.close()
+    """Returns the process-wide Neo4j connection, created on first use."""
+    global _db
+    if _db is None:
+        _db = Neo4jConnection()
+    return _db
+
+# Shared client for HTTP tool actions, so repeated calls to the same tool
+# endpoint reuse TCP+TLS connections; the semaphore caps concurrent calls
+_tool_http: Optional[httpx.AsyncClient] = None
+_tool_http_sem = asyncio.Semaphore(20)
+
+def get_tool_http() -> httpx.AsyncClient:
+    global _tool_http
+    if _tool_http is None:
+        _tool_http = httpx.AsyncClient(
+            timeout=60,
+            limits=httpx.Limits(
+                max_connections=64,
+                max_keepalive_connections=32,
+                keepalive_expiry=75
+            )
+        )
+    return _tool_http
+
+@web_app.on_event("shutdown")
+async def close_clients():
+    if _tool_http is not None:
+        await _tool_http.aclose()
+    if _db is not None:
+        await _db.close()
 
 async def get_session(db: Neo4jConnection = Depends(get_db)):
     """Yields a Neo4j session; closed after request."""
@@ -284,9 +309,9 @@ async def execute_tool_in_neo4j(tool_id: str, input_data: Dict[str, Any], sessio
         body = input_data
 
         logger.info(f"Performing HTTP request: {method.upper()} {url}")
-        async with httpx.AsyncClient(timeout=60) as client:
+        async with _tool_http_sem:
             try:
-                r = await client.request(method, url, headers=headers, json=body)
+                r = await get_tool_http().request(method, url, headers=headers, json=body)
                 r.raise_for_status()
                 return r.json()
             except httpx.HTTPError as e:
@@ -304,6 +329,15 @@ def _replace_params(template: str, params: Dict[str, Any]) -> str:
         template = template.replace(f"{{{k}}}", str(v))
     return template
 
+# Every new relay session lists the tools, so GET /tools is served from a
+# short-lived cache that the mutating endpoints clear
+TOOLS_CACHE_TTL = 30.0
+_tools_cache: Optional[tuple] = None  # (expires_at, tools)
+
+def _invalidate_tools_cache():
+    global _tools_cache
+    _tools_cache = None
+
 # CRUD endpoints
 @web_app.post("/tools", response_model=ToolResponse)
 async def create_tool(tool: Tool, session=Depends(get_session)):
@@ -439,11 +473,16 @@ async def create_tool(tool: Tool, session=Depends(get_session)):
         version="1.0.0"
     )
     logger.info(f"Tool created successfully: {tool.name} (id={tool_id})")
+    _invalidate_tools_cache()
     return response
 
 @web_app.get("/tools", response_model=List[ToolResponse])
 async def get_tools(session=Depends(get_session)):
     """Get all tools."""
+    global _tools_cache
+    now = time.monotonic()
+    if _tools_cache is not None and _tools_cache[0] > now:
+        return _tools_cache[1]
     logger.info("Fetching all tools")
     result = session.run(
         """
@@ -501,6 +540,7 @@ async def get_tools(session=Depends(get_session)):
         tools.append(tr)
 
     logger.info(f"Fetched {len(tools)} tools")
+    _tools_cache = (now + TOOLS_CACHE_TTL, tools)
     return tools
 
 @web_app.get("/tools/{tool_identifier}", response_model=ToolResponse)
@@ -721,6 +761,7 @@ async def update_tool(tool_id: str, tool: Tool, session=Depends(get_session)):
                 code=tool.code
             )
 
+    _invalidate_tools_cache()
     return await get_tool(tool_id, session)
 
 @web_app.delete("/tools/{tool_id}")
@@ -740,6 +781,7 @@ async def delete_tool(tool_id: str, session=Depends(get_session)):
         tid=tool_id
     ).single()
     count = result["deleted_count"] if result else 0
+    _invalidate_tools_cache()
     if count > 0:
         logger.info(f"Tool deleted successfully: {tool_id}")
         return {"message": "Tool deleted successfully"}